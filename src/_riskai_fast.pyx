@@ -0,0 +1,86 @@
+# cython: language_level=3
+# Compiled battle simulator used by riskai.py when available. Build it in
+# place with:
+#   python setup.py build_ext --inplace
+#
+# Dice come from libc rand(), whose state is global to the process: it is
+# shared with any other C code calling rand() and is not safe to use from
+# several threads at once.
+
+# Package imports:
+import os
+
+cimport cython
+from libc.stdlib cimport rand, srand, RAND_MAX
+
+# Functions:
+
+## Seeding:
+cpdef void seed(unsigned int value):
+    """Reseeds the process-wide C generator used for the dice."""
+    srand(value)
+
+def _reseed():
+    seed(int.from_bytes(os.urandom(4), "little"))
+
+# Seed from the OS on import, and again in every forked child so that worker
+# processes don't replay their parent's dice:
+_reseed()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed)
+
+## Die roll:
+cdef inline int _roll():
+    return 1 + <int>(rand() / (RAND_MAX + 1.0) * 6)
+
+## Battle simulator:
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef tuple simulate_battle(int n_atk, int n_def, int tests):
+    """
+    Fights `tests` battles of `n_atk` attackers against `n_def` defenders.
+
+    Returns a tuple (victories,
+                     surviving_attackers_sum,
+                     surviving_defenders_sum)
+    """
+    cdef int i, a, d, a1, a2, a3, d1, d2
+    cdef long victory = 0, a_sum = 0, d_sum = 0
+
+    for i in range(tests):
+        a = n_atk
+        d = n_def
+        while a > 1 and d > 0:
+            # Top two attacker dice, 0 standing for a die that isn't rolled:
+            a1 = _roll()
+            a2 = _roll() if a > 2 else 0
+            a3 = _roll() if a > 3 else 0
+            if a1 < a2:
+                a1, a2 = a2, a1
+            if a3 > a1:
+                a1, a2 = a3, a1
+            elif a3 > a2:
+                a2 = a3
+
+            d1 = _roll()
+            d2 = _roll() if d > 1 else 0
+            if d1 < d2:
+                d1, d2 = d2, d1
+
+            if a1 > d1:
+                d -= 1
+            else:
+                a -= 1
+            if a2 and d2:
+                if a2 > d2:
+                    d -= 1
+                else:
+                    a -= 1
+
+        if d == 0:
+            victory += 1
+            a_sum += a
+        else:
+            d_sum += d
+
+    return victory, a_sum, d_sum
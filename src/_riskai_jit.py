@@ -0,0 +1,66 @@
+# Numba-compiled battle simulator used by riskai.py when Numba is available.
+# riskai.py imports it only when a battle misses the precomputed table, since
+# loading Numba is slow.
+
+# Package imports:
+import numba
+import numpy as np
+
+# Functions:
+
+## Single battle:
+@numba.njit(cache=True)
+def _simulate_once(n_atk, n_def):
+    """
+    Fights a single battle. Returns a tuple (surviving_attackers,
+    surviving_defenders, victory).
+    """
+    a = n_atk
+    d = n_def
+    while a > 1 and d > 0:
+        # Top two attacker dice, 0 standing for a die that isn't rolled:
+        a1 = np.random.randint(1, 7)
+        a2 = np.random.randint(1, 7) if a > 2 else 0
+        a3 = np.random.randint(1, 7) if a > 3 else 0
+        if a1 < a2:
+            a1, a2 = a2, a1
+        if a3 > a1:
+            a1, a2 = a3, a1
+        elif a3 > a2:
+            a2 = a3
+
+        d1 = np.random.randint(1, 7)
+        d2 = np.random.randint(1, 7) if d > 1 else 0
+        if d1 < d2:
+            d1, d2 = d2, d1
+
+        if a1 > d1:
+            d -= 1
+        else:
+            a -= 1
+        if a2 and d2:
+            if a2 > d2:
+                d -= 1
+            else:
+                a -= 1
+    return a, d, d == 0
+
+## Battle simulator:
+@numba.njit(cache=True, parallel=True)
+def simulate_battle(n_atk, n_def, tests):
+    """
+    Fights `tests` battles spread across all cores.
+
+    Returns a tuple (victories,
+                     surviving_attackers_sum,
+                     surviving_defenders_sum)
+    """
+    victory = 0
+    a_sum = 0
+    d_sum = 0
+    for i in numba.prange(tests):
+        a, d, won = _simulate_once(n_atk, n_def)
+        victory += won
+        a_sum += a * won
+        d_sum += d * (1 - won)
+    return victory, a_sum, d_sum
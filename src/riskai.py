@@ -2,57 +2,267 @@
 
 # Package imports:
 import collections
+import concurrent.futures.process
+import functools
+import itertools
 import logging
+import multiprocessing
+import os
 import random
+import threading
+
+import numpy as np
+
+try:
+    from _riskai_fast import simulate_battle
+except ImportError:
+    simulate_battle = None
+
+# Module variables:
+TABLE_MAX = 50  # simulate() results for n_atk, n_def < TABLE_MAX are tabulated.
+PARALLEL_TESTS = 10000  # Tests per worker process for the NumPy engine.
+_rng = np.random.default_rng()   # PCG64 generator for the NumPy engine.
+
+# Functions:
+
+## Vectorized battle simulator:
+def _simulate_battles(n_atk, n_def, tests, _integers=_rng.integers,
+                      _sort=np.sort, _minimum=np.minimum,
+                      _count=np.count_nonzero):
+    """
+    Runs `tests` independent battles of `n_atk` attackers against `n_def`
+    defenders side by side. Every combat round rolls the dice of all battles
+    still being fought in a single call, so the cost is one NumPy operation per
+    round instead of one Python loop per die.
+
+    Returns a tuple (victories,
+                     surviving_attackers_sum,
+                     surviving_defenders_sum)
+    The underscored arguments bind the NumPy functions used every round as
+    locals.
+    """
+    # One flat array per battle field, as small as the armies allow:
+    dtype = np.int8 if max(n_atk, n_def) <= np.iinfo(np.int8).max else np.int32
+    a = np.full(tests, n_atk, dtype=dtype)
+    d = np.full(tests, n_def, dtype=dtype)
+    live = np.flatnonzero((a > 1) & (d > 0))
+    atk_cols = np.arange(3)
+    def_cols = np.arange(2)
+
+    # `live` holds the indices of the battles still being fought, so each
+    # round only touches those and the work shrinks as battles end.
+    while live.size:
+        a_live = a[live]
+        d_live = d[live]
+
+        # Roll the maximum number of dice and blank out the ones that can't be
+        # used. Blank dice are 0, so they end up last after sorting.
+        atk_dice = _minimum(a_live - 1, 3)
+        atk_roll = _integers(1, 7, size=(live.size, 3), dtype=np.int8)
+        atk_roll[atk_cols >= atk_dice[:, None]] = 0
+        atk_roll = _sort(atk_roll, axis=1)[:, ::-1]
+
+        def_dice = _minimum(d_live, 2)
+        def_roll = _integers(1, 7, size=(live.size, 2), dtype=np.int8)
+        def_roll[def_cols >= def_dice[:, None]] = 0
+        def_roll = _sort(def_roll, axis=1)[:, ::-1]
+
+        # Only the highest min(atk_dice, def_dice) pairs are compared:
+        compared = def_cols < _minimum(atk_dice, def_dice)[:, None]
+        atk_wins = atk_roll[:, :2] > def_roll
+
+        d_live = d_live - _count(atk_wins & compared, axis=1)
+        a_live = a_live - _count(~atk_wins & compared, axis=1)
+        d[live] = d_live
+        a[live] = a_live
+        live = live[(a_live > 1) & (d_live > 0)]
+
+    won = d == 0
+    return (int(np.count_nonzero(won)),
+            int(a[won].sum()),
+            int(d[~won].sum()))
+
+## Parallel battle simulator:
+def _simulate_chunk(n_atk, n_def, tests, seed):
+    """
+    Runs the NumPy engine with its own generator seeded from `seed`, so
+    worker processes forked from the same parent roll different dice.
+    """
+    rng = np.random.default_rng(seed)
+    return _simulate_battles(n_atk, n_def, tests, _integers=rng.integers)
+
+def _parallel_workers(tests):
+    """
+    Number of worker processes worth using for `tests` battles: one per
+    PARALLEL_TESTS tests, at most one per core. Workers are forked, so they
+    don't re-run the __main__ script; without fork this is always 1. It is
+    also 1 once the process runs other Python threads, since forking them
+    can deadlock the workers.
+    """
+    if ("fork" not in multiprocessing.get_all_start_methods()
+            or threading.active_count() > 1):
+        return 1
+    return min(os.cpu_count() or 1, tests // PARALLEL_TESTS)
+
+def _simulate_parallel(n_atk, n_def, tests):
+    """
+    Splits `tests` battles evenly across _parallel_workers(tests) forked
+    processes. The pool only lives for this call, so no worker is started
+    that the call doesn't use. If a worker dies, the battles are simulated
+    serially instead.
+
+    Returns the same tuple as _simulate_battles.
+    """
+    workers = _parallel_workers(tests)
+    seeds = np.random.SeedSequence().spawn(workers)
+    sizes = [tests // workers + (i < tests % workers) for i in range(workers)]
+    executor = concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("fork"))
+    try:
+        with executor:
+            futures = [executor.submit(_simulate_chunk, n_atk, n_def, size,
+                                       seed)
+                       for size, seed in zip(sizes, seeds)]
+            counts = [future.result() for future in futures]
+    except concurrent.futures.process.BrokenProcessPool:
+        return _simulate_battles(n_atk, n_def, tests)
+    return tuple(sum(c) for c in zip(*counts))
+
+## Numba battle simulator, imported on first use since Numba is slow to load:
+_jit_simulate_battle = None
+
+def _load_jit():
+    """
+    Imports the Numba battle simulator the first time a battle misses the
+    table. Returns its simulate_battle function, or None without Numba.
+    """
+    global _jit_simulate_battle
+    if _jit_simulate_battle is None:
+        try:
+            from _riskai_jit import simulate_battle as _jit_simulate_battle
+        except ImportError:
+            _jit_simulate_battle = False
+    return _jit_simulate_battle or None
+
+@functools.lru_cache(maxsize=8192)
+def _simulate(n_atk, n_def, tests):
+    """
+    Simulates `tests` battles with the fastest engine available. The Cython
+    engine is serial, so it only takes simulations of up to PARALLEL_TESTS
+    tests. Larger ones go to the Numba engine, which runs on all cores, or to
+    the NumPy engine spread across processes when more than one is worth
+    using, and otherwise to the fastest serial engine. Results are memoized,
+    keeping the most recently used battles.
+
+    Returns the same tuple as AI.simulate.
+    """
+    if simulate_battle is not None and tests <= PARALLEL_TESTS:
+        victory, a_sum, d_sum = simulate_battle(n_atk, n_def, tests)
+    elif _load_jit() is not None:
+        victory, a_sum, d_sum = _jit_simulate_battle(n_atk, n_def, tests)
+    elif _parallel_workers(tests) > 1:
+        victory, a_sum, d_sum = _simulate_parallel(n_atk, n_def, tests)
+    elif simulate_battle is not None:
+        victory, a_sum, d_sum = simulate_battle(n_atk, n_def, tests)
+    else:
+        victory, a_sum, d_sum = _simulate_battles(n_atk, n_def, tests)
+    return (float(victory) / tests,
+            float(a_sum) / victory if victory else 0,
+            float(d_sum) / (tests - victory) if tests - victory else 0)
+
+## Move strategy that leaves the most forces behind:
+def _move_one(n_atk):
+    return 1
+
+## Exact battle table:
+def _round_odds(atk_dice, def_dice):
+    """
+    Enumerates every roll of `atk_dice` against `def_dice` dice.
+
+    Returns a list of (attacker_losses, defender_losses, probability).
+    """
+    outcomes = collections.Counter()
+    for roll in itertools.product(range(1, 7), repeat=atk_dice + def_dice):
+        atk_roll = sorted(roll[:atk_dice], reverse=True)
+        def_roll = sorted(roll[atk_dice:], reverse=True)
+        def_losses = sum(a > d for a, d in zip(atk_roll, def_roll))
+        outcomes[(min(atk_dice, def_dice) - def_losses, def_losses)] += 1
+    total = 6 ** (atk_dice + def_dice)
+    return [(la, ld, float(n) / total) for (la, ld), n in outcomes.items()]
+
+@functools.lru_cache(maxsize=None)
+def _sim_table():
+    """
+    Solves the battle as a Markov chain for every battle with fewer than
+    TABLE_MAX attackers and defenders, returning the exact results indexed
+    [n_atk, n_def]. Every round removes at least one army, so each state only
+    depends on states already solved in row-major order. The table is solved
+    on first use and kept for the rest of the process.
+    """
+    odds = {(i, j): _round_odds(i, j) for i in (1, 2, 3) for j in (1, 2)}
+
+    # Probability of victory and the expected survivors on each outcome:
+    win = np.zeros((TABLE_MAX, TABLE_MAX))
+    a_win = np.zeros((TABLE_MAX, TABLE_MAX))
+    d_lose = np.zeros((TABLE_MAX, TABLE_MAX))
+    for a in range(TABLE_MAX):
+        for d in range(TABLE_MAX):
+            if d == 0:
+                win[a, d] = 1
+                a_win[a, d] = a
+            elif a <= 1:
+                d_lose[a, d] = d
+            else:
+                for la, ld, p in odds[(min(a - 1, 3), min(d, 2))]:
+                    win[a, d] += p * win[a - la, d - ld]
+                    a_win[a, d] += p * a_win[a - la, d - ld]
+                    d_lose[a, d] += p * d_lose[a - la, d - ld]
+
+    table = np.zeros((TABLE_MAX, TABLE_MAX, 3))
+    table[..., 0] = win
+    np.divide(a_win, win, out=table[..., 1], where=win > 0)
+    np.divide(d_lose, 1 - win, out=table[..., 2], where=win < 1)
+    return table
 
 # Classes:
 
+## Attack strategy:
+class Strategy(collections.namedtuple("Strategy", "kind threshold")):
+    """
+    Attack strategy given as data rather than as a function, so RiskBoard can
+    evaluate it with an inline comparison. With kind "threshold" the attack
+    continues while the attackers outnumber the defenders by more than
+    `threshold`. It can still be called as f(n_atk, n_def) by code expecting
+    a plain function.
+    """
+    __slots__ = ()
+
+    def __call__(self, n_atk, n_def):
+        return n_atk > n_def + self.threshold
+
 ## Base AI class template:
 class AI(object):
     """
     Base class for AIs to inherit from, containing some utility methods
     """
-    _sim_cache = {}
+    __slots__ = ('player', 'game', 'world', 'logger', '_enemy_adj')
+
     @classmethod
     def simulate(cls, n_atk, n_def, tests=1000):
         """
         Simulates the outcome of a battle with `n_atk` attackers and `n_def`
-        defenders. The battle is simulated `tests` times, and the result cached
+        defenders. Battles with fewer than TABLE_MAX attackers and defenders
+        are looked up in a table of exact results, solved on first use.
+        Otherwise the battle is simulated `tests` times, and the result cached
         and shared between all AI instances.
 
         Returns a tuple (probability_of_victory,
                          avg_surviving_attackers,
                          avg_surviving_defenders)
         """
-        if (n_atk, n_def) in cls._sim_cache:
-            return cls._sim_cache[(n_atk, n_def)]
-        a_survive = []
-        d_survive = []
-        victory = 0
-        for i in range(tests):
-            a = n_atk
-            d = n_def
-            while a > 1 and d > 0:
-                atk_dice = min(a - 1, 3)
-                atk_roll = sorted([random.randint(1, 6) for i in range(atk_dice)], reverse=True)
-                def_dice = min(d, 2)
-                def_roll = sorted([random.randint(1, 6) for i in range(def_dice)], reverse=True)
-
-                for aa, dd in zip(atk_roll, def_roll):
-                    if aa > dd:
-                        d -= 1
-                    else:
-                        a -= 1
-            if d == 0:
-                a_survive.append(a)
-                victory += 1
-            else:
-                d_survive.append(d)
-
-        cls._sim_cache[(n_atk, n_def)] = (float(victory) / tests,
-                                          (float(sum(a_survive)) / victory) if victory else 0,
-                                          (float(sum(d_survive)) / (tests - victory)) if tests - victory else 0)
-        return cls._sim_cache[(n_atk, n_def)]
+        if 0 <= n_atk < TABLE_MAX and 0 <= n_def < TABLE_MAX:
+            return tuple(float(x) for x in _sim_table()[n_atk, n_def])
+        return _simulate(n_atk, n_def, tests)
 
 
     def __init__(self, player, game, world):
@@ -68,21 +278,25 @@ class AI(object):
         self.world = world
         self.logger = logging.getLogger("pyrisk.ai.%s" % self.__class__.__name__)
 
-    def loginfo(self, msg, *args):
+    def loginfo(self, msg, *args, _INFO=logging.INFO):
         """
         Logging methods. These messages will appear at the bottom of the screen
         when in curses mode, on screen in console mode or in a logfile if you
-        specify that at the command line.
+        specify that at the command line. Messages below the logger's level
+        return before the logging call is made.
         """
-        self.logger.info(msg, *args)
+        if self.logger.isEnabledFor(_INFO):
+            self.logger.info(msg, *args)
 
-    def logwarn(self, msg, *args):
+    def logwarn(self, msg, *args, _WARNING=logging.WARNING):
         """As loginfo, but slightly more emphasis."""
-        self.logger.warn(msg, *args)
+        if self.logger.isEnabledFor(_WARNING):
+            self.logger.warn(msg, *args)
 
-    def logerror(self, msg, *args):
+    def logerror(self, msg, *args, _ERROR=logging.ERROR):
         """As loginfo, but will cause curses mode to pause for longer over this message."""
-        self.logger.error(msg, *args)
+        if self.logger.isEnabledFor(_ERROR):
+            self.logger.error(msg, *args)
 
     def start(self):
         """
@@ -101,14 +315,37 @@ class AI(object):
     def event(self, msg):
         """
         This method is called every time a game event occurs. `msg` will be a tuple
-        containing a string followed by a set of arguments, look in game.py to see
-        the types of messages that can be generated.
+        containing a string followed by a set of arguments, look in riskboard.py to
+        see the types of messages that can be generated.
 
         Implement it if you want to know what is happening during other player's
         turns, etc.
         """
         pass
 
+    def _track_enemies(self, msg):
+        """
+        Maintains `self._enemy_adj`, mapping each of the player's territories
+        to a list of its enemy neighbours. Call it from event() to have the map
+        built when the game starts and updated as territories change hands.
+        """
+        if msg[0] == "start":
+            self._enemy_adj = {t: [a for a in t.connect if a.owner != self.player]
+                               for t in self.player.territories}
+        elif msg[0] == "conquer":
+            player, opponent, target = msg[1], msg[2], msg[4]
+            if player == self.player:
+                self._enemy_adj[target] = [a for a in target.connect
+                                           if a.owner != self.player]
+                for a in target.connect:
+                    if a.owner == self.player:
+                        self._enemy_adj[a].remove(target)
+            elif opponent == self.player:
+                del self._enemy_adj[target]
+                for a in target.connect:
+                    if a.owner == self.player:
+                        self._enemy_adj[a].append(target)
+
     def initial_placement(self, empty, remaining):
         """
         Initial placement phase. Called repeatedly until initial forces are exhausted.
@@ -139,7 +376,8 @@ class AI(object):
 
         `src` and `dest` must be territory objects or names.
         `atk_strategy` should be a function f(n_atk, n_def) which returns True to
-        continue attacking, or None to use the default (attack until exhausted) strategy.
+        continue attacking, a Strategy, or None to use the default (attack until
+        exhausted) strategy.
         `move_strategy` should be a function f(n_atk) which returns the number
         of forces to move, or None to use the default (move maximum) behaviour.
         """
@@ -160,50 +398,51 @@ class BetterAI(AI):
     BetterAI: Thinks about what it is doing a little more - picks a priority
     continent and priorities holding and reinforcing it.
     """
+    __slots__ = ('area_priority', '_area_rank')
+
     def start(self):
         self.area_priority = list(self.world.areas)
         random.shuffle(self.area_priority)
+        self._area_rank = {name: i for i, name in enumerate(self.area_priority)}
 
     def priority(self):
-        priority = sorted([t for t in self.player.territories if t.border],
-                          key=lambda x: self.area_priority.index(x.area.name))
-        priority = [t for t in priority if t.area == priority[0].area]
-        return priority if priority else list(self.player.territories)
+        border = [t for t in self.player.territories if t.border]
+        if not border:
+            return list(self.player.territories)
+        area = min(border, key=lambda x: self._area_rank[x.area.name]).area
+        return [t for t in border if t.area == area]
 
 
     def initial_placement(self, empty, available):
         if empty:
-            empty = sorted(empty, key=lambda x: self.area_priority.index(x.area.name))
-            return empty[0]
+            return min(empty, key=lambda x: self._area_rank[x.area.name])
         else:
             return random.choice(self.priority())
 
     def reinforce(self, available):
         priority = self.priority()
-        result = collections.defaultdict(int)
-        while available:
-            result[random.choice(priority)] += 1
-            available -= 1
-        return result
+        return collections.Counter(random.choices(priority, k=available))
+
+    def event(self, msg):
+        self._track_enemies(msg)
 
     def attack(self):
         for t in self.player.territories:
             if t.forces > 1:
-                adjacent = [a for a in t.connect if a.owner != t.owner and t.forces >= a.forces + 3]
+                adjacent = [a for a in self._enemy_adj[t] if t.forces >= a.forces + 3]
                 if len(adjacent) == 1:
                         yield (t.name, adjacent[0].name,
-                               lambda a, d: a > d, None)
+                               Strategy("threshold", 0), None)
                 else:
                     total = sum(a.forces for a in adjacent)
                     for adj in adjacent:
-                        yield (t, adj, lambda a, d: a > d + total - adj.forces + 3,
-                               lambda a: 1)
+                        yield (t, adj, Strategy("threshold", total - adj.forces + 3),
+                               _move_one)
 
     def freemove(self):
-        srcs = sorted([t for t in self.player.territories if not t.border],
-                      key=lambda x: x.forces)
+        srcs = [t for t in self.player.territories if not t.border]
         if srcs:
-            src = srcs[-1]
+            src = max(srcs, key=lambda x: x.forces)
             n = src.forces - 1
             return (src, self.priority()[0], n)
         return None
@@ -214,6 +453,8 @@ class StupidAI(AI):
     StupidAI: Plays a completely random game, randomly choosing and reinforcing
     territories, and attacking wherever it can without any considerations of wisdom.
     """
+    __slots__ = ()
+
     def initial_placement(self, empty, remaining):
         if empty:
             return random.choice(empty)
@@ -221,17 +462,17 @@ class StupidAI(AI):
             t = random.choice(list(self.player.territories))
             return t
 
+    def event(self, msg):
+        self._track_enemies(msg)
+
     def attack(self):
         for t in self.player.territories:
-            for a in t.connect:
-                if a.owner != self.player:
+            if t.forces > 1:
+                # Copied, since conquering `a` removes it from the list:
+                for a in tuple(self._enemy_adj[t]):
                     if t.forces > a.forces:
                         yield (t, a, None, None)
 
     def reinforce(self, available):
         border = [t for t in self.player.territories if t.border]
-        result = collections.defaultdict(int)
-        for i in range(available):
-            t = random.choice(border)
-            result[t] += 1
-        return result
+        return collections.Counter(random.choices(border, k=available))
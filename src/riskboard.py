@@ -14,6 +14,44 @@ logger = logging.getLogger("risk-board")
 logger.setLevel(logging.DEBUG)
 logging.basicConfig()
 
+# Module variables:
+DIE_FACES = range(1, 7)
+DICE_BLOCK = 60     # Most dice drawn at once during combat (12 full rounds).
+
+# Functions:
+
+## Dice resolution:
+def _resolve(atk_roll, def_roll):
+    """
+    Resolves a single combat round from the attacker's 1-3 dice and the
+    defender's 1-2 dice, highest against highest. The top two attacker dice
+    are picked with plain comparisons instead of sorting the rolls.
+
+    Returns a tuple (attacker_losses, defender_losses).
+    """
+    if len(atk_roll) == 1 or len(def_roll) == 1:
+        return (0, 1) if max(atk_roll) > max(def_roll) else (1, 0)
+
+    if len(atk_roll) == 3:
+        a1, a2, a3 = atk_roll
+        if a1 < a2:
+            a1, a2 = a2, a1
+        if a3 > a1:
+            a1, a2 = a3, a1
+        elif a3 > a2:
+            a2 = a3
+    else:
+        a1, a2 = atk_roll
+        if a1 < a2:
+            a1, a2 = a2, a1
+
+    d1, d2 = def_roll
+    if d1 < d2:
+        d1, d2 = d2, d1
+
+    def_losses = (a1 > d1) + (a2 > d2)
+    return (2 - def_losses, def_losses)
+
 # Classes:
 
 ## Class to store the basic mechanics of a Risk game board.
@@ -64,6 +102,7 @@ class RiskBoard(object):
             self.turn += 1
 
         self.info("Board succesfully started!")
+        self.event(("start", self))
 
         # Now the board is all set for the game to start.
         # Remember, the game start with players choosing where to place their
@@ -132,22 +171,44 @@ class RiskBoard(object):
         n_atk = src.forces
         n_def = target.forces
 
+        # Threshold strategies are compared inline instead of being called:
+        threshold = None
         if f_atk is None:
             f_atk = lambda a, d: True
+        elif getattr(f_atk, "kind", None) == "threshold":
+            threshold = f_atk.threshold
         if f_move is None:
             f_move = lambda a: a - 1
 
-        while n_atk > 1 and n_def > 0 and f_atk(n_atk, n_def):
+        # Dice are drawn in blocks and consumed through a cursor, refilling
+        # whenever the next round doesn't fit. Each round removes at least one
+        # army and rolls no more dice than the one before, so a block never
+        # needs more than this round's dice times the remaining armies:
+        dice = []
+        cursor = 0
+
+        while n_atk > 1 and n_def > 0:
+            if threshold is None:
+                if not f_atk(n_atk, n_def):
+                    break
+            elif n_atk <= n_def + threshold:
+                break
+
             atk_dice = min(n_atk - 1, 3)
-            atk_roll = sorted([random.randint(1, 6) for i in range(atk_dice)], reverse=True)
             def_dice = min(n_def, 2)
-            def_roll = sorted([random.randint(1, 6) for i in range(def_dice)], reverse=True)
+            if cursor + atk_dice + def_dice > len(dice):
+                block = (atk_dice + def_dice) * (n_atk - 1 + n_def)
+                dice = random.choices(DIE_FACES, k=min(DICE_BLOCK, block))
+                cursor = 0
 
-            for a, d in zip(atk_roll, def_roll):
-                if a > d:
-                    n_def -= 1
-                else:
-                    n_atk -= 1
+            atk_roll = dice[cursor:cursor + atk_dice]
+            cursor += atk_dice
+            def_roll = dice[cursor:cursor + def_dice]
+            cursor += def_dice
+
+            atk_losses, def_losses = _resolve(atk_roll, def_roll)
+            n_atk -= atk_losses
+            n_def -= def_losses
 
         if n_def == 0:
             move = f_move(n_atk)
@@ -161,7 +222,9 @@ class RiskBoard(object):
                 move = max_move
             src.forces = n_atk - move
             target.forces = move
+            opponent = target.owner
             target.owner = src.owner
+            self.event(("conquer", src.owner, opponent, src, target))
             return True
 
         else:
@@ -169,6 +232,12 @@ class RiskBoard(object):
             target.forces = n_def
             return False
 
+    ## Method to notify the AIs of a game event:
+    def event(self, msg):
+        for p in self.players.values():
+            if p.type == "AI":
+                p.ai.event(msg)
+
     ## Method to show if the initial placement ended:
     def finishedInitialPlacement(self):
         return sum(self.initial_troops.values()) == 0
@@ -0,0 +1,12 @@
+# Build script for the optional compiled battle simulator. Run it from this
+# directory with:
+#   python setup.py build_ext --inplace
+
+# Package imports:
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="riskai-fast",
+    ext_modules=cythonize("_riskai_fast.pyx"),
+)